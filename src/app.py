@@ -1,5 +1,6 @@
 import sys
 
+import orjson
 from flask import Flask, request, jsonify
 from certmanager import challenge, CertAuthority, crypto
 from certmanager.Acme import AcmeError
@@ -24,8 +25,9 @@ def obtain_cert():
     data, error = certAuthority.obtainCert(hostnames)
 
     if data:
-        return jsonify(
-            data.__json__()
+        return app.response_class(
+            orjson.dumps(data.__json__()),
+            mimetype="application/json",
             # {
             #     "existing": existing,
             #     "new": {
@@ -1,7 +1,6 @@
 import os
 from typing import Union, List, Tuple
 import json
-import requests as req
 from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePrivateKey
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
@@ -33,17 +32,25 @@ class AcmeHttpError(AcmeError):
 
 
 class Acme:
-    def __init__(self, account_key: Union[RSAPrivateKey, EllipticCurvePrivateKey], url=acme_url):
+    def __init__(
+        self,
+        account_key: Union[RSAPrivateKey, EllipticCurvePrivateKey],
+        url=acme_url,
+        session: requests.Session = None,
+    ):
         self.account_key = account_key
         # json web key format for public key
         self.jwk = jwk(self.account_key)
         self.nonce = None
         self.key_id = None
-        self.directory = requests.get(acme_url).json()
+        self.url = url
+        # all requests to the ACME server go through one session, so they reuse its TLS connections
+        self.session = session if session is not None else requests.Session()
+        self.directory = self.session.get(self.url).json()
 
     def _directory(self, key):
         if not self.directory:
-            self.directory = req.get(acme_url)
+            self.directory = self.session.get(self.url).json()
         return self.directory[key]
 
     def _directory_req(self, path_name, payload, depth=0):
@@ -56,7 +63,7 @@ class Acme:
         protected = {
             "url": url,
             "alg": get_algorithm_name(self.account_key),
-            "nonce": req.get(self._directory("newNonce")).headers.get("Replay-Nonce"),
+            "nonce": self.session.get(self._directory("newNonce")).headers.get("Replay-Nonce"),
         }
         if self.key_id:
             protected["kid"] = self.key_id
@@ -70,7 +77,7 @@ class Acme:
         }
 
         print("-" * 30 + " Request  " + "-" * 30)
-        response = req.post(url, json=payload, headers={"Content-Type": "application/jose+json"})
+        response = self.session.post(url, json=payload, headers={"Content-Type": "application/jose+json"})
         print(url)
         if response.status_code != 200:
             print(json.dumps({x[0]: x[1] for x in response.headers.items()}, indent=2))
@@ -123,7 +130,7 @@ class Order:
         return [x for x in self.all_challenges if not x.verified]
 
     def refresh(self):
-        response = requests.get(self.url)
+        response = self._acme.session.get(self.url)
         if response.status_code == 200:
             self._data = response.json()
             self.status = self._data["status"]
@@ -184,7 +191,7 @@ class Challenge:
     def self_verify(self) -> Union[bool, requests.Response]:
         identifier = self._data["identifier"]
         if identifier["type"] == "dns":
-            res = requests.get(self.url)
+            res = self._acme.session.get(self.url)
             if res.status_code == 200 and res.content == self.token.encode():
                 return True
             else:
@@ -1,87 +1,115 @@
 from typing import List, Union, Callable, Tuple, Dict
 import json
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from cryptography.x509 import Certificate
 from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from . import Acme, Challenge, Order
 from . import db
 from . import crypto
 from . import challenge
 from .crypto import cert_to_pem, key_to_pem
-from .crypto_classes import Key
+from .crypto_classes import Key, LazyCert
 from .db import KeyStore
 
 
 class CertAuthority:
+    # how long a stored ACME account registration is trusted before registering again
+    registration_ttl = 24 * 60 * 60
+
     def __init__(self, challenge_store: challenge.ChallengeStore, key_store: KeyStore):
-        self.acme = Acme(key_store.account_key)
+        session = requests.Session()
+        # Retry only covers idempotent requests; signed POSTs carry a single-use nonce and are never replayed.
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        self.acme = Acme(key_store.account_key, session=session)
         self.key_store = key_store
+        self._register()
+
+        self.challengesStore: challenge.ChallengeStore = challenge_store
+
+    def _register(self):
+        meta_key = "acme_registered:" + self.acme.url
+        registered = self.key_store.get_meta(meta_key)
+        if registered is not None:
+            registered = json.loads(registered)
+            if time.time() - registered["registered_at"] < self.registration_ttl:
+                self.acme.key_id = registered["account"]
+                return
+
         res: Response = self.acme.register()
         if res.status_code == 201:
             print("Acme Account was already registered")
         elif res.status_code != 200:
             raise Exception("Acme registration didn't return 200 or 201 ", res.json())
-
-        self.challengesStore: challenge.ChallengeStore = challenge_store
+        if self.acme.key_id:
+            self.key_store.set_meta(meta_key, json.dumps({"account": self.acme.key_id, "registered_at": time.time()}))
 
     def obtainCert(self, host) -> (Union[Certificate, None], requests.Response):
-        if type(host) == str:
+        if isinstance(host, str):
             host = [host]
+        host = list(dict.fromkeys(host))  # drop duplicates, keeping order
 
-        existing = {c[0]: c[1] for c in [(h, self.key_store.get_cert(h)) for h in host] if c[1] is not None}
+        existing = self.key_store.get_certs(host)
         missing = [h for h in host if h not in existing]
-        if len(missing) > 0:
+        if missing:
             private_key = crypto.gen_key_secp256r1()
             order, (error) = self.acme.create_authorized_order(missing)
 
             if order is None:
                 err: requests.Response = error
-                raise ValueError("Unexpected response code :" + str(err.status_code) + json.dumps(err.json(), 2))
+                raise ValueError("Unexpected response code :" + str(err.status_code) + json.dumps(err.json(), indent=2))
             order: Order = order  # just for typehint
             challenges = order.remaining_challenges()
             for c in challenges:
                 print("[ Challenge ]", c.token, "=", c.authorization_key)
                 self.challengesStore[c.token] = c.authorization_key
                 # c.self_verify()
-                c.verify()
-
-            end = time.time() + 40  # max 12 seconds
-            source: List[Challenge] = [x for x in challenges]
-            sink = []
-            counter = 1
-            while len(source) > 0:
-                if time.time() > end and counter > 4:
-                    print("Order finalization time out")
-                    break
-                for c in source:
-                    status, maybe_request = c.query_progress()
-                    if status != True:  # NOTE that it must be True strictly
-                        sink.append(c)
-                if len(sink) > 0:
-                    time.sleep(3)
-                source, sink, counter = sink, [], counter + 1
-            else:
-                print("Order is alrealdy Ready.")
+
+            # each challenge is an independent round trip to the ACME server
+            with ThreadPoolExecutor(max_workers=max(1, min(16, len(challenges)))) as executor:
+                list(executor.map(lambda c: c.verify(), challenges))
+
+                end = time.time() + 40  # max 12 seconds
+                source: List[Challenge] = [x for x in challenges]
+                sink = []
+                counter = 1
+                while source:
+                    if time.time() > end and counter > 4:
+                        print("Order finalization time out")
+                        break
+                    for c, (status, maybe_request) in zip(source, executor.map(lambda c: c.query_progress(), source)):
+                        if status != True:  # NOTE that it must be True strictly
+                            sink.append(c)
+                    if sink:
+                        time.sleep(min(10, 2 ** (counter - 1)))  # 1s, 2s, 4s, 8s, then every 10s
+                    source, sink, counter = sink, [], counter + 1
+                else:
+                    print("Order is alrealdy Ready.")
             csr = crypto.create_csr(private_key, missing[0], missing[1:])
             order.finalize(csr)
 
             def obtain_cert(count=5):
-                time.sleep(3)
-                order.refresh()
-                if order.status == "valid":
-                    (certificate, _) = order.get_certificate()
-                    key_id = self.key_store.save_key(private_key, missing[0])
-                    cert_id = self.key_store.save_cert(key_id, certificate, missing)
-                    issued_cert = IssuedCert(key_to_pem(private_key), certificate, missing)
-                    response = createExistingResponse(existing, [issued_cert])
-                    return (response, None)
-                elif order.status == "processing":
-                    if count == 0:
-                        return None, error
-                    return obtain_cert()
+                delay = 1
+                for _ in range(count + 1):
+                    time.sleep(delay)
+                    delay = min(delay * 2, 10)
+                    order.refresh()
+                    if order.status == "valid":
+                        (certificate, _) = order.get_certificate()
+                        key_id = self.key_store.save_key(private_key, missing[0])
+                        cert_id = self.key_store.save_cert(key_id, certificate, missing)
+                        issued_cert = IssuedCert(key_to_pem(private_key), certificate, missing)
+                        response = createExistingResponse(existing, [issued_cert])
+                        return (response, None)
+                    elif order.status != "processing":
+                        break
                 return None, error
 
             return obtain_cert()
@@ -89,20 +117,21 @@ class CertAuthority:
             return createExistingResponse(existing, []), None
 
 
+def cert_pem_str(cert: Certificate | LazyCert) -> str:
+    # certificates from the key store cache keep their encoding, others are encoded on each call
+    if isinstance(cert, LazyCert):
+        return cert.pem_str
+    return cert_to_pem(cert).decode("utf-8")
+
+
 def createExistingResponse(existing: Dict[str, Tuple[int | str, Key, Certificate]], issued_certs: List["IssuedCert"]):
-    certs = []
-    certMap = {}
+    domains_by_id = defaultdict(list)
+    pem_by_id = {}
     for h, (id, key, cert) in existing.items():
-        if id in certMap:
-            certMap[id][0].append(h)
-        else:
-            certMap[id] = (
-                [h],
-                key.to_pem().decode("utf-8"),
-                cert_to_pem(cert).decode("utf-8"),
-            )
-    for hosts, key, cert in certMap.values():
-        certs.append(IssuedCert(key, cert, hosts))
+        domains_by_id[id].append(h)
+        if id not in pem_by_id:
+            pem_by_id[id] = (key.pem_str, cert_pem_str(cert))
+    certs = [IssuedCert(*pem_by_id[id], hosts) for id, hosts in domains_by_id.items()]
 
     return CertificateResponse(certs, issued_certs)
 
@@ -131,11 +160,11 @@ class CertificateResponse:
 class IssuedCert:
     def __init__(self, key: str | Key, cert: str | Certificate, domains: [str]):
         if isinstance(key, Key):
-            key = key.to_pem().decode("utf-8")
+            key = key.pem_str
         elif isinstance(key, bytes):
             key = key.decode("utf-8")
-        if isinstance(cert, Certificate):
-            cert = cert_to_pem(cert).decode("utf-8")
+        if isinstance(cert, (Certificate, LazyCert)):
+            cert = cert_pem_str(cert)
         elif isinstance(cert, bytes):
             cert = cert.decode("utf-8")
         self.privateKey = key
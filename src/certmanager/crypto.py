@@ -11,6 +11,7 @@ from cryptography.x509 import Certificate, CertificateSigningRequestBuilder, Cer
 
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes
+import base64
 import datetime
 
 from .util import b64_encode, b64_string
@@ -104,6 +105,14 @@ def cert_to_pem(cert):
     return cert.public_bytes(serialization.Encoding.PEM)
 
 
+def der_to_pem(der: bytes, label: str) -> bytes:
+    # PEM is just the base64 DER in 64 character lines between BEGIN/END banners
+    b64 = base64.b64encode(der)
+    lines = [b64[i : i + 64] for i in range(0, len(b64), 64)]
+    banner = label.encode("ascii")
+    return b"-----BEGIN " + banner + b"-----\n" + b"\n".join(lines) + b"\n-----END " + banner + b"-----\n"
+
+
 def cert_from_der(data: bytes) -> Certificate:
     return x509.load_der_x509_certificate(data)
 
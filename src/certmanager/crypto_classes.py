@@ -1,11 +1,13 @@
 from abc import ABC, abstractmethod
+from functools import cached_property
 from cryptography.hazmat.primitives.asymmetric import rsa, ed25519, ec
 from cryptography.hazmat.primitives import serialization, hashes, hmac, padding
 from typing import Union
 
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.x509 import Certificate
 
-from .crypto import key_to_der, key_to_pem
+from .crypto import key_to_der, key_to_pem, der_to_pem, cert_from_der
 from .util import b64_string
 
 
@@ -52,6 +54,10 @@ class Key(ABC):
     def to_pem(self) -> bytes:
         return key_to_pem(self.key)
 
+    @cached_property
+    def pem_str(self) -> str:
+        return self.to_pem().decode("utf-8")
+
 
 class RSAKey(Key):
     def __init__(self, key: rsa.RSAPrivateKey, hasher=hashes.SHA256()):
@@ -133,3 +139,74 @@ class ECDSAKey(Key):
 
     def sign_csr(self, csr):
         return csr.sign(self.key, hashes.SHA256())
+
+
+class LazyKey(Key):
+    """
+    PKCS#8 DER encoded private key that is only parsed when it's used for signing.
+    """
+
+    def __init__(self, der: bytes):
+        self.der = der
+
+    @cached_property
+    def parsed(self) -> Key:
+        return Key.from_der(self.der)
+
+    @property
+    def key(self):
+        return self.parsed.key
+
+    def jwk(self):
+        return self.parsed.jwk()
+
+    def sign(self, message):
+        return self.parsed.sign(message)
+
+    def sign_csr(self, csr):
+        return self.parsed.sign_csr(csr)
+
+    def to_der(self) -> bytes:
+        return self.der
+
+    def to_pem(self) -> bytes:
+        return der_to_pem(self.der, "PRIVATE KEY")
+
+
+class LazyCert:
+    """
+    DER encoded certificate that is only parsed when something other than its encoding is needed.
+    """
+
+    def __init__(self, der: bytes):
+        self.der = der
+
+    @cached_property
+    def cert(self) -> Certificate:
+        return cert_from_der(self.der)
+
+    def public_bytes(self, encoding: serialization.Encoding) -> bytes:
+        if encoding == serialization.Encoding.DER:
+            return self.der
+        elif encoding == serialization.Encoding.PEM:
+            return der_to_pem(self.der, "CERTIFICATE")
+        return self.cert.public_bytes(encoding)
+
+    @cached_property
+    def pem_str(self) -> str:
+        return self.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+
+    def __getattr__(self, name):
+        # only reached for attributes LazyCert doesn't have; never forward its own state or dunder lookups
+        if name in ("der", "cert") or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.cert, name)
+
+    def __eq__(self, other):
+        if isinstance(other, (LazyCert, Certificate)):
+            return self.der == other.public_bytes(serialization.Encoding.DER)
+        return NotImplemented
+
+    def __hash__(self):
+        # equal to a Certificate with the same content, so it has to hash like one
+        return hash(self.cert)
@@ -1,11 +1,46 @@
 import sqlite3
-from typing import Union, Tuple
+import threading
+from collections import OrderedDict
+from typing import Union, Tuple, Dict
 from .crypto import *
+import errno
 import os
-from flask import g
+import uuid
 from abc import ABC, abstractmethod
 
-from .crypto_classes import Key
+from .crypto_classes import Key, LazyKey, LazyCert
+
+# INSERT ... RETURNING is available from sqlite 3.35
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_RETURNING_ID = " RETURNING id" if _SQLITE_HAS_RETURNING else ""
+
+# statements are built once, so every call hits the connection's prepared statement cache
+_SQL_INSERT_KEY = "INSERT INTO private_keys (name, content) VALUES (?, ?)" + _RETURNING_ID
+_SQL_GET_KEY_CONTENT = "SELECT content FROM private_keys WHERE id = ?"
+_SQL_GET_KEY_BY_NAME = "SELECT content FROM private_keys WHERE name = ?"
+_SQL_INSERT_CERT = "INSERT INTO certificates (name, priv_id, content, key_content) VALUES (?, ?, ?, ?)" + _RETURNING_ID
+# re-issuing a domain points it to the new certificate
+_SQL_INSERT_DOMAIN = "INSERT OR REPLACE INTO ssl_domains (domain, certificate_id) VALUES (?, ?)"
+_SQL_GET_CERT = """
+    SELECT c.id, c.key_content, c.content
+    FROM ssl_domains s
+    JOIN certificates c ON s.certificate_id = c.id
+    WHERE s.domain = ?
+"""
+_SQL_GET_CERTS = """
+    SELECT s.domain, c.id, c.key_content, c.content
+    FROM ssl_domains s
+    JOIN certificates c ON s.certificate_id = c.id
+    WHERE s.domain IN ({0})
+"""
+_SQL_GET_META = "SELECT v FROM meta WHERE k = ?"
+_SQL_SET_META = "INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)"
+
+
+def _insert_returning_id(conn: sqlite3.Connection, sql: str, params) -> int:
+    cur = conn.execute(sql, params)
+    # fetchall() steps the statement to completion so it doesn't hold the write lock
+    return cur.fetchall()[0][0] if _SQLITE_HAS_RETURNING else cur.lastrowid
 
 
 class KeyStore(ABC):
@@ -27,11 +62,38 @@ class KeyStore(ABC):
     def get_cert(self, domain: str) -> None | Tuple[int | str, Key, Certificate]:
         pass
 
+    def get_certs(self, domains: List[str]) -> Dict[str, Tuple[int | str, Key, Certificate]]:
+        found = {}
+        for domain in domains:
+            res = self.get_cert(domain)
+            if res is not None:
+                found[domain] = res
+        return found
+
+    def get_meta(self, key: str) -> None | str:
+        return None
+
+    def set_meta(self, key: str, value: str):
+        pass
+
 
 class SqliteKeyStore(KeyStore):
-    def __init__(self, db_path="db/database.db"):
+    def __init__(self, db_path="db/database.db", cert_cache_size=1024):
         self.db_path = db_path
+        # (id, key, certificate) per domain, most recently used last.
+        self._cert_cache: OrderedDict[str, Tuple[int, LazyKey, LazyCert]] = OrderedDict()
+        self._cert_cache_size = cert_cache_size
+        self._cert_cache_lock = threading.Lock()
+        # bumped by every save_cert; lookups that raced with a save don't populate the cache
+        self._cert_cache_generation = 0
         self._initialize_db()
+        # long-lived connections keep sqlite's page cache warm across requests.
+        # Writes share one connection and are serialized by the lock. Each thread looks up through its own
+        # read connection: a WAL read snapshot belongs to the connection, so a shared one would let a lookup
+        # inherit the older snapshot of another thread's lookup that is still running.
+        self._conn = self._connect()
+        self._write_lock = threading.Lock()
+        self._read_local = threading.local()
         self.account_key = self._init_account_key()
 
     def _initialize_db(self):
@@ -49,7 +111,8 @@ class SqliteKeyStore(KeyStore):
                     name VARCHAR(50) NULL,
                     priv_id INTEGER REFERENCES private_keys NOT NULL,
                     content BLOB,
-                    sign_id INTEGER REFERENCES private_keys NULL
+                    sign_id INTEGER REFERENCES private_keys NULL,
+                    key_content BLOB
                 );
                 CREATE TABLE IF NOT EXISTS ssl_domains (
                     domain VARCHAR(255),
@@ -59,21 +122,75 @@ class SqliteKeyStore(KeyStore):
                     domain VARCHAR(255),
                     certificate_id INTEGER REFERENCES certificates
                 );
+                CREATE TABLE IF NOT EXISTS meta (
+                    k TEXT PRIMARY KEY,
+                    v TEXT
+                );
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                PRAGMA temp_store=MEMORY;
+                PRAGMA cache_size=-20000;
+                PRAGMA busy_timeout=5000;
                 """
             )
+            if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                self._migrate_key_content(conn)
+
+    @staticmethod
+    def _migrate_key_content(conn: sqlite3.Connection):
+        """
+        Schema v1: copy each certificate's private key into its row and make ssl_domains.domain unique,
+        so a lookup is one indexed search and a single join.
+        """
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(certificates)")]
+        if "key_content" not in columns:
+            conn.execute("ALTER TABLE certificates ADD COLUMN key_content BLOB")
+        conn.executescript(
+            """
+            BEGIN;
+            UPDATE certificates SET key_content = (SELECT content FROM private_keys WHERE id = priv_id)
+            WHERE key_content IS NULL;
+            -- a domain maps to the most recently saved certificate
+            DELETE FROM ssl_domains WHERE certificate_id < (
+                SELECT MAX(s.certificate_id) FROM ssl_domains s WHERE s.domain = ssl_domains.domain
+            );
+            -- the remaining duplicates are identical rows, any one of them can stay
+            DELETE FROM ssl_domains WHERE rowid NOT IN (SELECT MIN(rowid) FROM ssl_domains GROUP BY domain);
+            DROP INDEX IF EXISTS idx_ssl_domains_domain;
+            CREATE UNIQUE INDEX idx_ssl_domains_domain ON ssl_domains(domain);
+            PRAGMA user_version = 1;
+            COMMIT;
+            """
+        )
 
-    def _get_db_connection(self):
-        if "db" not in g:
-            g.db = sqlite3.connect(self.db_path)
-        return g.db
+    @property
+    def _read_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._read_local, "conn", None)
+        if conn is None:
+            conn = self._read_local.conn = self._connect(query_only=True)
+        return conn
+
+    def _connect(self, query_only=False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, isolation_level=None, cached_statements=256
+        )
+        # journal_mode is persisted in the database file, the rest are per-connection.
+        conn.executescript(
+            """
+            PRAGMA busy_timeout=5000;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA foreign_keys=ON;
+            """
+        )
+        if query_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
 
     def save_key(self, key: RSAPrivateKey, name: str = None) -> int:
-        conn = self._get_db_connection()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO private_keys (name, content) VALUES (?, ?)", (name, key_to_der(key)))
-        cur.close()
-        conn.commit()
-        return cur.lastrowid
+        with self._write_lock:
+            return _insert_returning_id(self._conn, _SQL_INSERT_KEY, (name, sqlite3.Binary(key_to_der(key))))
 
     def gen_key(self, name: str = None, size: int = 4096) -> RSAPrivateKey:
         key = gen_key_rsa(size)
@@ -81,43 +198,99 @@ class SqliteKeyStore(KeyStore):
         return key
 
     def save_cert(self, private_key_id: int, cert: Certificate, domains: List[str], name: str = None) -> int:
-        conn = self._get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO certificates (name, priv_id, content) VALUES (?, ?, ?)",
-            (name, private_key_id, cert.public_bytes(serialization.Encoding.DER)),
-        )
-        cert_id = cur.lastrowid
-
-        for domain in domains:
-            cur.execute("INSERT INTO ssl_domains (domain, certificate_id) VALUES (?, ?)", (domain, cert_id))
-        cur.close()
-        conn.commit()
+        conn = self._conn
+        with self._write_lock, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            key_content = conn.execute(_SQL_GET_KEY_CONTENT, (private_key_id,)).fetchone()
+            if key_content is None:
+                raise ValueError("No private key with id " + str(private_key_id))
+            cert_id = _insert_returning_id(
+                conn,
+                _SQL_INSERT_CERT,
+                (
+                    name,
+                    private_key_id,
+                    sqlite3.Binary(cert.public_bytes(serialization.Encoding.DER)),
+                    key_content[0],
+                ),
+            )
+            conn.executemany(_SQL_INSERT_DOMAIN, [(d, cert_id) for d in domains])
+        with self._cert_cache_lock:
+            self._cert_cache_generation += 1
+            for domain in domains:
+                self._cert_cache.pop(domain, None)
         return cert_id
 
     def get_cert(self, domain: str) -> None | Tuple[int | str, Key, Certificate]:
-        conn = self._get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT c.id, p.content, c.content
-            FROM ssl_domains s
-            JOIN certificates c ON s.certificate_id = c.id
-            JOIN private_keys p ON c.priv_id = p.id
-            WHERE s.domain = ?
-            """,
-            (domain,),
-        )
-        res = cur.fetchone()
-
-        cur.close()
-
-        return res if res is None else (res[0], Key.from_der(res[1]), cert_from_der(res[2]))
+        with self._cert_cache_lock:
+            cached = self._cert_cache.get(domain)
+            if cached is not None:
+                self._cert_cache.move_to_end(domain)
+                return cached
+            generation = self._cert_cache_generation
+        res = self._get_cert_uncached(domain)
+        if res is not None:
+            self._cache_certs({domain: res}, generation)
+        return res
+
+    def get_certs(self, domains: List[str]) -> Dict[str, Tuple[int, LazyKey, LazyCert]]:
+        found = {}
+        with self._cert_cache_lock:
+            for domain in domains:
+                cached = self._cert_cache.get(domain)
+                if cached is not None:
+                    self._cert_cache.move_to_end(domain)
+                    found[domain] = cached
+            generation = self._cert_cache_generation
+        missing = [d for d in domains if d not in found]
+        if not missing:
+            return found
+
+        rows = self._read_conn.execute(_SQL_GET_CERTS.format(",".join("?" * len(missing))), missing).fetchall()
+
+        # SANs of the same certificate share one tuple, so it's parsed/encoded at most once
+        by_id = {}
+        fetched = {}
+        for domain, cert_id, key_der, cert_der in rows:
+            if cert_id not in by_id:
+                by_id[cert_id] = (cert_id, LazyKey(key_der), LazyCert(cert_der))
+            fetched[domain] = by_id[cert_id]
+        self._cache_certs(fetched, generation)
+        found.update(fetched)
+        return found
+
+    def get_meta(self, key: str) -> None | str:
+        rows = self._read_conn.execute(_SQL_GET_META, (key,)).fetchall()
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value: str):
+        with self._write_lock:
+            self._conn.execute(_SQL_SET_META, (key, value))
+
+    def _cache_certs(self, certs: Dict[str, Tuple[int, LazyKey, LazyCert]], generation: int):
+        with self._cert_cache_lock:
+            # save_cert bumps the generation after committing, and a lookup takes it before starting a new read
+            # snapshot on its own thread's connection. So the same generation means no save committed after the
+            # snapshot began, and a different one means the rows may already be stale.
+            if generation != self._cert_cache_generation:
+                return
+            for domain, res in certs.items():
+                self._cert_cache[domain] = res
+                self._cert_cache.move_to_end(domain)
+            while len(self._cert_cache) > self._cert_cache_size:
+                self._cert_cache.popitem(last=False)
+
+    def _get_cert_uncached(self, domain: str) -> None | Tuple[int, LazyKey, LazyCert]:
+        # fetchall() finishes the statement, so the read snapshot ends before the result is cached
+        rows = self._read_conn.execute(_SQL_GET_CERT, (domain,)).fetchall()
+        if not rows:
+            return None
+        (cert_id, key_der, cert_der) = rows[0]
+        return (cert_id, LazyKey(key_der), LazyCert(cert_der))
 
     def _init_account_key(self) -> RSAPrivateKey:
         acme_key_name = "ACME Account Key"
-        conn = sqlite3.connect(self.db_path)
-        account_key_data = conn.execute("SELECT content FROM private_keys WHERE name = ?", [acme_key_name]).fetchone()
+        account_key_data = self._read_conn.execute(_SQL_GET_KEY_BY_NAME, [acme_key_name]).fetchone()
 
         if not account_key_data:
             account_key = self.gen_key(acme_key_name)
@@ -125,10 +298,42 @@ class SqliteKeyStore(KeyStore):
             account_key = key_from_der(account_key_data[0])
 
         print(key_to_pem(account_key).decode("utf-8"))
-        conn.close()
         return account_key
 
 
+def _temp_path(path: str) -> str:
+    return "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+
+
+def _replace_file(path: str, data: bytes):
+    # write next to the target and rename over it, so other hard links to the old file keep their content.
+    # O_EXCL: never write through an existing file, it may be a hard link shared with other domains.
+    tmp_path = _temp_path(path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _replace_with_link(src: str, dst: str):
+    # hard link where the filesystem supports it, otherwise copy
+    tmp_path = _temp_path(dst)
+    try:
+        os.link(src, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+            raise
+        with open(src, "rb") as f:
+            _replace_file(dst, f.read())
+        return
+    os.replace(tmp_path, dst)
+
+
 class FilesystemKeyStore(KeyStore):
     def __init__(self, base_dir="."):
         self.keys_dir = os.path.join(base_dir, "keys")
@@ -146,8 +351,7 @@ class FilesystemKeyStore(KeyStore):
 
     def save_key(self, key: RSAPrivateKey, name: str = None) -> int:
         key_path = os.path.join(self.keys_dir, f"{name}.key")
-        with open(key_path, "wb") as f:
-            f.write(key_to_pem(key))
+        _replace_file(key_path, key_to_pem(key))
         return name  # Dummy ID since filesystem does not use numeric IDs
 
     def gen_key(self, name: str = None, size: int = 4096) -> RSAPrivateKey:
@@ -172,21 +376,16 @@ class FilesystemKeyStore(KeyStore):
         return None
 
     def save_cert(self, private_key_id: str, cert: Certificate, domains: list, name: str = None) -> int:
-        if name:
-            cert_path = os.path.join(self.certs_dir, f"{name}.crt")
-            with open(cert_path, "wb") as f:
-                f.write(cert_to_pem(cert))
-        key_content = None
+        # the certificate is written once, every other domain links to the same file
+        cert_path = os.path.join(self.certs_dir, f"{name if name else domains[0]}.crt")
+        _replace_file(cert_path, cert_to_pem(cert))
         key_path = os.path.join(self.keys_dir, f"{private_key_id}.key")
-        with open(key_path, "rb") as f:
-            key_content = f.read()
         for domain in domains:
             if domain != private_key_id:
-                with open(os.path.join(self.keys_dir, f"{domain}.key"), "wb") as f:
-                    f.write(key_content)
+                _replace_with_link(key_path, os.path.join(self.keys_dir, f"{domain}.key"))
             domain_cert_path = os.path.join(self.certs_dir, f"{domain}.crt")
-            with open(domain_cert_path, "wb") as f:
-                f.write(cert_to_pem(cert))
+            if domain_cert_path != cert_path:
+                _replace_with_link(cert_path, domain_cert_path)
 
         return name if name else domains[0]  # Dummy ID since filesystem does not use numeric IDs
 
@@ -0,0 +1,122 @@
+import json
+import os
+import time
+
+import pytest
+from certmanager import certauthority
+from certmanager.crypto import gen_key_rsa
+from certmanager.custom_certauthority import CustomCertAuthority
+from certmanager.certauthority import CertAuthority
+from certmanager.challenge import InMemoryChallengeStore
+from certmanager.db import SqliteKeyStore
+
+
+class StubAcme:
+    def __init__(self, account_key, url="https://acme.test/directory", session=None):
+        self.url = url
+        self.key_id = None
+        self.registrations = 0
+
+    def register(self):
+        self.registrations += 1
+        self.key_id = "https://acme.test/acct/1"
+        return StubResponse()
+
+    def create_authorized_order(self, domains):
+        return StubOrder(domains), None
+
+
+class StubChallenge:
+    def __init__(self, domain):
+        self.token = "token-" + domain
+        self.authorization_key = self.token + ".thumbprint"
+        self.verified = False
+        self.polls = 0
+
+    def verify(self):
+        self.verified = True
+        return True
+
+    def query_progress(self):
+        self.polls += 1
+        return self.verified, None
+
+
+class StubOrder:
+    def __init__(self, domains):
+        self.challenges = [StubChallenge(d) for d in domains]
+        (_, self.certificate) = CustomCertAuthority(gen_key_rsa(2048)).create_cert(domains[0], key_type="ecdsa")
+        self.status = "pending"
+
+    def remaining_challenges(self):
+        return self.challenges
+
+    def finalize(self, csr):
+        self.status = "processing"
+
+    def refresh(self):
+        self.status = "valid"
+
+    def get_certificate(self):
+        return self.certificate, None
+
+
+class StubResponse:
+    status_code = 200
+
+
+@pytest.fixture
+def key_store(tmp_path):
+    return SqliteKeyStore(os.path.join(tmp_path, "db", "database.db"))
+
+
+@pytest.fixture
+def stub_acme(monkeypatch):
+    monkeypatch.setattr(certauthority, "Acme", StubAcme)
+
+
+def store_registration(key_store, url, registered_at):
+    key_store.set_meta(
+        "acme_registered:" + url,
+        json.dumps({"account": "https://acme.test/acct/stored", "registered_at": registered_at}),
+    )
+
+
+def test_register_and_reuse(key_store, stub_acme):
+    first = CertAuthority(InMemoryChallengeStore(), key_store)
+    assert first.acme.registrations == 1
+    second = CertAuthority(InMemoryChallengeStore(), key_store)
+    assert second.acme.registrations == 0
+    assert second.acme.key_id == "https://acme.test/acct/1"
+
+
+def test_fresh_registration_skips_register(key_store, stub_acme):
+    store_registration(key_store, "https://acme.test/directory", time.time())
+    authority = CertAuthority(InMemoryChallengeStore(), key_store)
+    assert authority.acme.registrations == 0
+    assert authority.acme.key_id == "https://acme.test/acct/stored"
+
+
+def test_expired_registration_registers(key_store, stub_acme):
+    store_registration(key_store, "https://acme.test/directory", time.time() - CertAuthority.registration_ttl - 1)
+    authority = CertAuthority(InMemoryChallengeStore(), key_store)
+    assert authority.acme.registrations == 1
+    assert authority.acme.key_id == "https://acme.test/acct/1"
+
+
+def test_other_directory_registers(key_store, stub_acme):
+    store_registration(key_store, "https://other.test/directory", time.time())
+    authority = CertAuthority(InMemoryChallengeStore(), key_store)
+    assert authority.acme.registrations == 1
+    assert authority.acme.key_id == "https://acme.test/acct/1"
+
+
+def test_obtain_cert_with_stub_challenges(key_store, stub_acme, monkeypatch):
+    monkeypatch.setattr(certauthority.time, "sleep", lambda seconds: None)
+    challenges = InMemoryChallengeStore()
+    authority = CertAuthority(challenges, key_store)
+    (response, error) = authority.obtainCert(["a.sireto.io", "b.sireto.io", "a.sireto.io"])
+    assert error is None
+    assert [c.domains for c in response.issued] == [["a.sireto.io", "b.sireto.io"]]
+    assert set(challenges) == {"token-a.sireto.io", "token-b.sireto.io"}
+    assert set(key_store.get_certs(["a.sireto.io", "b.sireto.io"])) == {"a.sireto.io", "b.sireto.io"}
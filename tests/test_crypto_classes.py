@@ -0,0 +1,40 @@
+import copy
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from certmanager.crypto import gen_key_rsa, gen_key_secp256r1, key_to_der, key_to_pem, cert_to_pem
+from certmanager.crypto_classes import LazyCert, LazyKey
+from certmanager.custom_certauthority import CustomCertAuthority
+
+
+@pytest.fixture
+def issued():
+    return CustomCertAuthority(gen_key_rsa(2048)).create_cert("a.sireto.io", key_type="rsa")
+
+
+def test_lazy_cert_equality(issued):
+    (key, cert) = issued
+    lazy = LazyCert(cert.public_bytes(serialization.Encoding.DER))
+    assert lazy == cert and cert == lazy
+    assert hash(lazy) == hash(cert)
+    assert len({lazy, cert}) == 1
+
+
+@pytest.mark.parametrize("key", [gen_key_rsa(2048), gen_key_secp256r1()])
+def test_lazy_key_pem(key):
+    assert LazyKey(key_to_der(key)).to_pem() == key_to_pem(key)
+
+
+def test_lazy_cert_pem(issued):
+    (key, cert) = issued
+    lazy = LazyCert(cert.public_bytes(serialization.Encoding.DER))
+    assert lazy.public_bytes(serialization.Encoding.PEM) == cert_to_pem(cert)
+    assert lazy.pem_str == cert_to_pem(cert).decode("utf-8")
+
+
+def test_lazy_cert_copy(issued):
+    (key, cert) = issued
+    lazy = LazyCert(cert.public_bytes(serialization.Encoding.DER))
+    copied = copy.copy(lazy)
+    assert copied == lazy
+    assert copied.subject == cert.subject
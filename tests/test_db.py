@@ -0,0 +1,222 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from certmanager.crypto import gen_key_rsa, key_to_der
+from certmanager import db
+from certmanager.custom_certauthority import CustomCertAuthority
+from certmanager.db import SqliteKeyStore, FilesystemKeyStore
+
+
+@pytest.fixture
+def key_store(tmp_path):
+    return SqliteKeyStore(os.path.join(tmp_path, "db", "database.db"))
+
+
+@pytest.fixture
+def issued(key_store):
+    (key, cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert("a.sireto.io", key_type="ecdsa")
+    key_id = key_store.save_key(key, "a.sireto.io")
+    cert_id = key_store.save_cert(key_id, cert, ["a.sireto.io", "b.sireto.io"])
+    return cert_id, key, cert
+
+
+def test_get_cert(key_store, issued):
+    cert_id, key, cert = issued
+    (found_id, found_key, found_cert) = key_store.get_cert("b.sireto.io")
+    assert found_id == cert_id
+    assert found_cert == cert
+    assert key_store.get_cert("c.sireto.io") is None
+
+
+def test_get_certs(key_store, issued):
+    cert_id, key, cert = issued
+    reopened = SqliteKeyStore(key_store.db_path)
+    found = reopened.get_certs(["a.sireto.io", "b.sireto.io", "c.sireto.io"])
+    assert set(found) == {"a.sireto.io", "b.sireto.io"}
+    assert found["a.sireto.io"] is found["b.sireto.io"]
+    assert found["a.sireto.io"][0] == cert_id
+
+
+def test_connection_pragmas(key_store):
+    assert key_store._conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    assert key_store._conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_reissue_replaces_cached_cert(key_store, issued):
+    cert_id, key, cert = issued
+    assert key_store.get_cert("b.sireto.io")[0] == cert_id
+    (new_key, new_cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert("b.sireto.io", key_type="ecdsa")
+    new_id = key_store.save_cert(key_store.save_key(new_key, "b.sireto.io"), new_cert, ["b.sireto.io"])
+    assert key_store.get_cert("b.sireto.io")[0] == new_id
+    assert key_store.get_cert("a.sireto.io")[0] == cert_id
+
+
+def test_stale_read_is_not_cached(key_store, issued):
+    cert_id, key, cert = issued
+    # a lookup that read its rows before a save_cert must not put them back in the cache
+    generation = key_store._cert_cache_generation
+    stale = key_store._get_cert_uncached("a.sireto.io")
+    (new_key, new_cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert("a.sireto.io", key_type="ecdsa")
+    new_id = key_store.save_cert(key_store.save_key(new_key, "a.sireto.io"), new_cert, ["a.sireto.io"])
+    key_store._cache_certs({"a.sireto.io": stale}, generation)
+    assert key_store.get_cert("a.sireto.io")[0] == new_id
+
+
+def test_lookup_ignores_uncommitted_writes(key_store, issued):
+    cert_id, key, cert = issued
+    key_store._conn.execute("BEGIN IMMEDIATE")
+    try:
+        key_store._conn.execute(
+            "INSERT INTO ssl_domains (domain, certificate_id) VALUES (?, ?)", ("c.sireto.io", cert_id)
+        )
+        assert key_store.get_cert("c.sireto.io") is None
+    finally:
+        key_store._conn.execute("ROLLBACK")
+    assert key_store.get_cert("c.sireto.io") is None
+
+
+def test_migrate_baseline_schema(tmp_path):
+    db_path = os.path.join(tmp_path, "db", "database.db")
+    os.makedirs(os.path.dirname(db_path))
+    (key, cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert("a.sireto.io", key_type="ecdsa")
+    cert_der = cert.public_bytes(serialization.Encoding.DER)
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(
+            """
+            CREATE TABLE private_keys (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(50) NULL, content BLOB);
+            CREATE TABLE certificates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(50) NULL,
+                priv_id INTEGER REFERENCES private_keys NOT NULL,
+                content BLOB,
+                sign_id INTEGER REFERENCES private_keys NULL
+            );
+            CREATE TABLE ssl_domains (domain VARCHAR(255), certificate_id INTEGER REFERENCES certificates);
+            """
+        )
+        conn.execute("INSERT INTO private_keys (name, content) VALUES (?, ?)", ("a.sireto.io", key_to_der(key)))
+        conn.executemany("INSERT INTO certificates (priv_id, content) VALUES (1, ?)", [(cert_der,), (cert_der,)])
+        # newest certificate inserted first, so rowid order disagrees with certificate order
+        conn.executemany(
+            "INSERT INTO ssl_domains (domain, certificate_id) VALUES (?, ?)",
+            [("a.sireto.io", 2), ("a.sireto.io", 1), ("b.sireto.io", 1), ("b.sireto.io", 1)],
+        )
+    conn.close()
+
+    key_store = SqliteKeyStore(db_path)
+    conn = key_store._conn
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 1
+    backfilled = conn.execute("SELECT COUNT(*) FROM certificates WHERE key_content = ?", (key_to_der(key),))
+    assert backfilled.fetchone()[0] == 2
+    assert conn.execute("SELECT domain, certificate_id FROM ssl_domains ORDER BY domain").fetchall() == [
+        ("a.sireto.io", 2),
+        ("b.sireto.io", 1),
+    ]
+    assert key_store.get_cert("a.sireto.io")[1].to_der() == key_to_der(key)
+
+
+@pytest.fixture
+def fs_key_store(tmp_path):
+    return FilesystemKeyStore(str(tmp_path))
+
+
+def _issue(key_store, domains):
+    (key, cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert(domains[0], key_type="ecdsa")
+    key_store.save_cert(key_store.save_key(key, domains[0]), cert, domains)
+    return key, cert
+
+
+def test_filesystem_links_domains(fs_key_store):
+    _issue(fs_key_store, ["a.x", "b.x", "c.x"])
+    for kind, directory in (("crt", fs_key_store.certs_dir), ("key", fs_key_store.keys_dir)):
+        paths = [os.path.join(directory, f"{d}.{kind}") for d in ("a.x", "b.x", "c.x")]
+        inodes = {os.stat(p).st_ino for p in paths}
+        assert len(inodes) == 1
+        assert os.stat(paths[0]).st_nlink == 3
+    assert not [f for f in os.listdir(fs_key_store.keys_dir) if f.endswith(".tmp")]
+
+
+def test_filesystem_reissue_one_domain(fs_key_store):
+    (old_key, old_cert) = _issue(fs_key_store, ["a.x", "b.x", "c.x"])
+    (new_key, new_cert) = _issue(fs_key_store, ["c.x"])
+    for domain in ("a.x", "b.x"):
+        (_, key, cert) = fs_key_store.get_cert(domain)
+        assert cert == old_cert
+        assert key.to_der() == key_to_der(old_key)
+    (_, key, cert) = fs_key_store.get_cert("c.x")
+    assert cert == new_cert
+    assert key.to_der() == key_to_der(new_key)
+
+
+def test_filesystem_never_writes_through_stale_temp(fs_key_store, monkeypatch):
+    _issue(fs_key_store, ["a.x", "c.x"])
+    key_path = os.path.join(fs_key_store.keys_dir, "a.x.key")
+    with open(key_path, "rb") as f:
+        content = f.read()
+    # a temp file left behind as a hard link to another domain's key
+    stale = os.path.join(fs_key_store.keys_dir, "c.x.key.stale.tmp")
+    os.link(key_path, stale)
+    monkeypatch.setattr(db, "_temp_path", lambda path: path + ".stale.tmp")
+    with pytest.raises(FileExistsError):
+        fs_key_store.save_key(gen_key_rsa(2048), "c.x")
+    with open(key_path, "rb") as f:
+        assert f.read() == content
+
+
+def test_meta(key_store):
+    assert key_store.get_meta("k") is None
+    key_store.set_meta("k", "v1")
+    key_store.set_meta("k", "v2")
+    assert key_store.get_meta("k") == "v2"
+    assert SqliteKeyStore(key_store.db_path).get_meta("k") == "v2"
+
+
+def _hold_read_open(key_store):
+    """
+    Starts a thread that keeps a lookup statement open on its read connection until the returned event is set.
+    """
+    opened, release = threading.Event(), threading.Event()
+
+    def run():
+        cur = key_store._read_conn.execute("SELECT domain FROM ssl_domains")
+        cur.fetchone()
+        opened.set()
+        release.wait()
+        cur.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    opened.wait()
+    return thread, release
+
+
+def test_lookup_sees_commits_while_other_reads_are_open(key_store, issued):
+    cert_id, key, cert = issued
+    thread, release = _hold_read_open(key_store)
+    try:
+        (new_key, new_cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert("b.sireto.io", key_type="ecdsa")
+        new_id = key_store.save_cert(key_store.save_key(new_key, "b.sireto.io"), new_cert, ["b.sireto.io"])
+        assert key_store.get_cert("b.sireto.io")[0] == new_id
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_overlapping_lookup_caches_new_cert(key_store, issued):
+    cert_id, key, cert = issued
+    assert key_store.get_certs(["a.sireto.io", "b.sireto.io"])["b.sireto.io"][0] == cert_id
+    thread, release = _hold_read_open(key_store)
+    try:
+        (new_key, new_cert) = CustomCertAuthority(gen_key_rsa(2048)).create_cert("b.sireto.io", key_type="ecdsa")
+        new_id = key_store.save_cert(key_store.save_key(new_key, "b.sireto.io"), new_cert, ["b.sireto.io"])
+        found = key_store.get_certs(["a.sireto.io", "b.sireto.io"])
+        assert found["b.sireto.io"][0] == new_id
+        assert found["a.sireto.io"][0] == cert_id
+    finally:
+        release.set()
+        thread.join()
+    assert key_store._cert_cache["b.sireto.io"][0] == new_id
+    assert key_store.get_cert("b.sireto.io")[0] == new_id